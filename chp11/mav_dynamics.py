@@ -7,7 +7,9 @@ mav_dynamics
 import sys
 sys.path.append('..')
 import numpy as np
-from math import asin, exp, acos
+from math import asin, exp, acos, sin, cos
+from numba import njit
+from scipy.integrate import RK45, DOP853
 
 # load message types
 from messages.state_msg import StateMsg
@@ -17,13 +19,41 @@ import parameters.aerosonde_parameters as MAV
 import parameters.sensor_parameters as SENSOR
 from tools.tools import Quaternion2Euler, Quaternion2Rotation
 
+# adaptive solvers that can be selected instead of the fixed step RK4
+ADAPTIVE_INTEGRATORS = {'rk45': RK45, 'dop853': DOP853}
+
 class mav_dynamics:
-    def __init__(self, Ts):
+    def __init__(self, Ts, integrator='rk4', rtol=1e-6, atol=1e-9):
         self.ts_simulation = Ts
+        # 'rk4' is the fixed step integrator, deterministic and cheap enough for real time.
+        # 'rk45' or 'dop853' integrate each Ts with an adaptive scipy solver instead,
+        # holding the forces and moments over Ts (zero order hold on the controls).
+        if integrator != 'rk4' and integrator not in ADAPTIVE_INTEGRATORS:
+            raise ValueError('Unknown integrator: ' + str(integrator))
+        self.integrator = integrator
+        self._rtol = rtol
+        self._atol = atol
+        self._step_size = None  # last adaptive step, seeds the next solver
         # _state = [pn, pe, pd, u, v, w, e0, e1, e2, e3, p, q, r]
+        # kept flat (shape (13,)) so the compiled kernels can work on it directly
         self._state = np.array([MAV.pn0, MAV.pe0, MAV.pd0, MAV.u0, MAV.v0, MAV.w0,
-                                MAV.e0, MAV.e1, MAV.e2, MAV.e3, MAV.p0, MAV.q0, MAV.r0])
-        self._state = self._state.reshape((13, 1))
+                                MAV.e0, MAV.e1, MAV.e2, MAV.e3, MAV.p0, MAV.q0, MAV.r0],
+                               dtype=np.float64)
+        # preallocated buffers for the RK4 stages, rows are [k1, k2, k3, k4, intermediate state]
+        self._stages = np.empty((5, 13))
+        # forcing terms of the derivatives, constant over one RK4 step
+        self._forcing = np.empty(6)
+        # constant parameters passed to the compiled kernels
+        self._force_params = (float(MAV.mass), float(MAV.Jy), MAV.gamma3, MAV.gamma4, MAV.gamma8)
+        self._mav_params = (MAV.gamma1, MAV.gamma2, MAV.gamma5, MAV.gamma6, MAV.gamma7)
+
+        # rotation from body to inertial frame, refreshed in updateVelocityData
+        self._Rv_b = np.empty((3, 3))
+        # weight of the aircraft, gravity in the vehicle frame is [0, 0, _weight]
+        self._weight = MAV.mass * MAV.gravity
+        # exp(-M*(alpha - alpha0)) * exp(M*(alpha + alpha0)) does not depend on alpha,
+        # so the lift blending function needs only one exponential per call
+        self._exp_2Malpha0 = exp(2 * MAV.M * MAV.alpha0)
 
         self._wind = np.zeros((3, 1))
         self.updateVelocityData()
@@ -52,24 +82,15 @@ class mav_dynamics:
 
         forces_moments = self.calcForcesAndMoments(deltas)
 
-        # Integrate ODE using Runge-Kutta RK4 algorithm
         time_step = self.ts_simulation
-        k1 = self._derivatives(self._state, forces_moments)
-        k2 = self._derivatives(self._state + time_step/2.*k1, forces_moments)
-        k3 = self._derivatives(self._state + time_step/2.*k2, forces_moments)
-        k4 = self._derivatives(self._state + time_step*k3, forces_moments)
-        self._state += time_step/6 * (k1 + 2*k2 + 2*k3 + k4)
-
-        # normalize the quaternion
-        e0 = self._state.item(6)
-        e1 = self._state.item(7)
-        e2 = self._state.item(8)
-        e3 = self._state.item(9)
-        normE = np.sqrt(e0**2+e1**2+e2**2+e3**2)
-        self._state[6][0] = self._state.item(6)/normE
-        self._state[7][0] = self._state.item(7)/normE
-        self._state[8][0] = self._state.item(8)/normE
-        self._state[9][0] = self._state.item(9)/normE
+        if self.integrator == 'rk4':
+            # Integrate ODE using Runge-Kutta RK4 algorithm, the whole step is one compiled call
+            _rk4_step_nb(self._state, forces_moments.reshape(6), self._forcing, self._stages,
+                         self._force_params, self._mav_params, time_step)
+        else:
+            # the forces and moments are held over the step, so scale them only once
+            _forcing_nb(forces_moments.reshape(6), *self._force_params, self._forcing)
+            self._integrate_adaptive(time_step)
 
         #update velocities
         self.updateVelocityData(wind)
@@ -113,73 +134,56 @@ class mav_dynamics:
 
     ###################################
     # private functions
+    def _integrate_adaptive(self, time_step):
+        # integrate over [0, time_step] with as few steps as the tolerances allow
+        solver = ADAPTIVE_INTEGRATORS[self.integrator](self._ode, 0.0, self._state, time_step,
+                                                       first_step=self._step_size,
+                                                       rtol=self._rtol, atol=self._atol)
+        step_size = 0.0
+        while solver.status == 'running':
+            solver.step()
+            # the last step is clipped at time_step, so remember the largest one
+            step_size = max(step_size, solver.step_size)
+        if solver.status == 'failed':
+            print('Error in mav_dynamics: adaptive integration failed.')
+            return
+        self._step_size = step_size
+        self._state[:] = solver.y
+
+        # normalize the quaternion
+        e = self._state[6:10]
+        e /= np.sqrt(e @ e)
+
+    def _ode(self, t, x):
+        # xdot = f(x, u) with the forcing held at its value for the current step
+        x_dot = np.empty(13)
+        _derivs_nb(x, self._forcing, *self._mav_params, x_dot)
+        return x_dot
+
     def _derivatives(self, state, forces_moments):
         """
         for the dynamics xdot = f(x, u), returns f(x, u)
         """
-        # extract the states
-        pn = state.item(0)
-        pe = state.item(1)
-        pd = state.item(2)
-        u = state.item(3)
-        v = state.item(4)
-        w = state.item(5)
-        e0 = state.item(6)
-        e1 = state.item(7)
-        e2 = state.item(8)
-        e3 = state.item(9)
-        p = state.item(10)
-        q = state.item(11)
-        r = state.item(12)
-        #   extract forces/moments
-        fx = forces_moments.item(0)
-        fy = forces_moments.item(1)
-        fz = forces_moments.item(2)
-        l = forces_moments.item(3)
-        m = forces_moments.item(4)
-        n = forces_moments.item(5)
-
-        # position kinematics
-        Rv_b = Quaternion2Rotation(np.array([e0, e1, e2, e3]))
-
-        pos_dot = Rv_b @ np.array([u, v, w]).T
-        pn_dot = pos_dot.item(0)
-        pe_dot = pos_dot.item(1)
-        pd_dot = pos_dot.item(2)
-
-        # position dynamics
-        u_dot = r*v - q*w + 1/MAV.mass * fx
-        v_dot = p*w - r*u + 1/MAV.mass * fy
-        w_dot = q*u - p*v + 1/MAV.mass * fz
-
-        # rotational kinematics
-        e0_dot = (-p * e1 - q * e2 - r * e3) * 0.5
-        e1_dot = (p * e0 + r * e2 - q * e3) * 0.5
-        e2_dot = (q * e0 - r * e1 + p * e3) * 0.5
-        e3_dot = (r * e0 + q * e1 - p * e2) * 0.5
-
-        # rotatonal dynamics
-        p_dot = MAV.gamma1 * p * q - MAV.gamma2 * q * r + MAV.gamma3 * l + MAV.gamma4 * n
-        q_dot = MAV.gamma5 * p * r - MAV.gamma6 * (p**2 - r**2) + 1/MAV.Jy * m
-        r_dot = MAV.gamma7 * p * q - MAV.gamma1 * q * r + MAV.gamma4 * l + MAV.gamma8 * n
-
-        # collect the derivative of the states
-        x_dot = np.array([[pn_dot, pe_dot, pd_dot, u_dot, v_dot, w_dot,
-                           e0_dot, e1_dot, e2_dot, e3_dot, p_dot, q_dot, r_dot]]).T
-        return x_dot
+        x_dot = np.empty(13)
+        forcing = np.empty(6)
+        _forcing_nb(np.ascontiguousarray(forces_moments, dtype=np.float64).reshape(6),
+                    *self._force_params, forcing)
+        _derivs_nb(np.ascontiguousarray(state, dtype=np.float64).reshape(13),
+                   forcing, *self._mav_params, x_dot)
+        return x_dot.reshape(np.shape(state))
 
     def _update_msg_true_state(self):
         # update the true state message:
         phi, theta, psi = Quaternion2Euler(self._state[6:10])
-        self.msg_true_state.pn = self._state.item(0)
-        self.msg_true_state.pe = self._state.item(1)
-        self.msg_true_state.h = -self._state.item(2)
+        self.msg_true_state.pn = self._state[0]
+        self.msg_true_state.pe = self._state[1]
+        self.msg_true_state.h = -self._state[2]
         self.msg_true_state.phi = phi
         self.msg_true_state.theta = theta
         self.msg_true_state.psi = psi
-        self.msg_true_state.p = self._state.item(10)
-        self.msg_true_state.q = self._state.item(11)
-        self.msg_true_state.r = self._state.item(12)
+        self.msg_true_state.p = self._state[10]
+        self.msg_true_state.q = self._state[11]
+        self.msg_true_state.r = self._state[12]
         self.msg_true_state.Va = self._Va
         self.msg_true_state.alpha = self._alpha  # see line 164 updateVelocityData
         self.msg_true_state.beta = self._beta  # see line 167 updateVelocityData
@@ -189,29 +193,29 @@ class mav_dynamics:
         self.msg_true_state.we = self._wind.item(1)
 
     def calcGammaAndChi(self):
-        Rv_b = Quaternion2Rotation(self._state[6:10])
-        Vg = Rv_b @ self._state[3:6]
+        Vg = self._Rv_b @ self._state[3:6]
 
         gamma = asin(-Vg.item(2)/np.linalg.norm(Vg)) #negative because h_dot = Vg sin(gamma)
         self.msg_true_state.gamma = gamma
 
         Vg_horz = Vg * np.cos(gamma)
-        e1 = np.array([[1, 0, 0]]).T
 
-        chi = acos(np.dot(e1.T, Vg_horz) / np.linalg.norm(Vg_horz))
+        chi = acos(Vg_horz[0] / np.linalg.norm(Vg_horz))
         if(Vg_horz.item(1) < 0):
             chi *= -1
         self.msg_true_state.chi = chi
 
 
     def updateVelocityData(self, wind=np.zeros((6, 1))):
-        Rb_v = Quaternion2Rotation(self._state[6:10]).T
+        # the state has changed, so refresh the cached rotation
+        Quaternion2Rotation(self._state[6:10], out=self._Rv_b)
+        Rb_v = self._Rv_b.T
         #wind in body frame
         self._wind = Rb_v @ wind[0:3] + wind[3:]
         V = self._state[3:6]
 
         #Compute Va
-        Vr = V - self._wind
+        Vr = V - self._wind.reshape(3)
         self._Va = np.linalg.norm(Vr)
 
         #Compute alpha
@@ -229,17 +233,17 @@ class mav_dynamics:
 
     def calcForcesAndMoments(self, delta):
         # Calculate gravitational forces in the body frame
-        Rb_v = Quaternion2Rotation(self._state[6:10]).T
-        fb_grav = Rb_v @ np.array([[0, 0, MAV.mass * MAV.gravity]]).T
+        # Rb_v @ [0, 0, mg] is mg times the last column of Rb_v, i.e. the last row of Rv_b
+        fb_grav = self._weight * self._Rv_b[2]
 
         # Calculating longitudinal forces and moments
         fx, fz, m = self.calcLongitudinalForcesAndMoments(delta.item(0))
-        fx += fb_grav.item(0)
-        fz += fb_grav.item(2)
+        fx += fb_grav[0]
+        fz += fb_grav[2]
 
         # Calculating lateral forces and moments
         fy, l, n = self.calcLateralForcesAndMoments(delta.item(2), delta.item(3))
-        fy += fb_grav.item(1)
+        fy += fb_grav[1]
 
         # Propeller force and moments
         #These may act a little fast
@@ -278,8 +282,8 @@ class mav_dynamics:
         b = MAV.b
         Va = self._Va
         beta = self._beta
-        p = self._state.item(10)
-        r = self._state.item(12)
+        p = self._state[10]
+        r = self._state[12]
         rho = MAV.rho
         S = MAV.S_wing
 
@@ -307,27 +311,133 @@ class mav_dynamics:
         rho = MAV.rho
         Va = self._Va
         S = MAV.S_wing
-        q = self._state.item(11)
+        q = self._state[11]
         c = MAV.c
 
         c2V = c / (2. * Va)
         q_bar = 0.5 * rho * (Va**2) * S
-        e_negM = exp(-M * (alpha - alpha0))
         e_posM = exp(M * (alpha + alpha0))
+        e_negM = self._exp_2Malpha0 / e_posM  # exp(-M * (alpha - alpha0))
 
         sigma_alpha = (1 + e_negM + e_posM) / ((1 + e_negM)*(1 + e_posM))
 
+        # sign(alpha) * sin(alpha)**2 is sin(alpha) * |sin(alpha)|
+        sa = sin(alpha)
+        ca = cos(alpha)
         CL_alpha = (1 - sigma_alpha) * (MAV.C_L_0 + MAV.C_L_alpha * alpha) + \
-                    sigma_alpha * (2 * np.sign(alpha) * (np.sin(alpha)**2) * np.cos(alpha))
+                    sigma_alpha * (2 * sa * abs(sa) * ca)
         F_lift = q_bar * (CL_alpha + MAV.C_L_q * c2V * q + MAV.C_L_delta_e * de)
 
         CD_alpha = MAV.C_D_p + ((MAV.C_L_0 + MAV.C_L_alpha * alpha)**2) / (np.pi * MAV.e * MAV.AR)
         F_drag = q_bar * (CD_alpha + MAV.C_D_q * c2V * q + MAV.C_D_delta_e * de)
 
-        Rb_s = np.array([[np.cos(alpha), -np.sin(alpha)],
-                         [np.sin(alpha), np.cos(alpha)]])
-        fx_fz = Rb_s @ np.array([[-F_drag, -F_lift]]).T
+        # rotate lift and drag from the stability frame into the body frame
+        fx = -ca * F_drag + sa * F_lift
+        fz = -sa * F_drag - ca * F_lift
 
         m = q_bar * c * (MAV.C_m_0 + MAV.C_m_alpha * alpha + MAV.C_m_q * c2V * q + MAV.C_m_delta_e * de)
 
-        return fx_fz.item(0), fx_fz.item(1), m
+        return fx, fz, m
+
+
+###################################
+# compiled kernels
+@njit(cache=True, fastmath=True)
+def _forcing_nb(fm, mass, Jy, gamma3, gamma4, gamma8, out):
+    # forces/moments [fx, fy, fz, l, m, n] scaled into the terms they add to
+    # [u_dot, v_dot, w_dot, p_dot, q_dot, r_dot]
+    out[0] = fm[0] / mass
+    out[1] = fm[1] / mass
+    out[2] = fm[2] / mass
+    out[3] = gamma3 * fm[3] + gamma4 * fm[5]
+    out[4] = fm[4] / Jy
+    out[5] = gamma4 * fm[3] + gamma8 * fm[5]
+
+@njit(cache=True, fastmath=True)
+def _derivs_nb(state, forcing, gamma1, gamma2, gamma5, gamma6, gamma7, out):
+    """
+    for the dynamics xdot = f(x, u), writes f(x, u) into out
+    forcing holds the force/moment terms from _forcing_nb
+    """
+    # extract the states
+    u = state[3]
+    v = state[4]
+    w = state[5]
+    e0 = state[6]
+    e1 = state[7]
+    e2 = state[8]
+    e3 = state[9]
+    p = state[10]
+    q = state[11]
+    r = state[12]
+
+    # position kinematics (Rv_b @ [u, v, w]) expanded in the quaternion products
+    e00 = e0*e0
+    e11 = e1*e1
+    e22 = e2*e2
+    e33 = e3*e3
+    e01 = e0*e1
+    e02 = e0*e2
+    e03 = e0*e3
+    e12 = e1*e2
+    e13 = e1*e3
+    e23 = e2*e3
+    out[0] = (e00 + e11 - e22 - e33)*u + 2*((e12 - e03)*v + (e13 + e02)*w)
+    out[1] = (e00 - e11 + e22 - e33)*v + 2*((e12 + e03)*u + (e23 - e01)*w)
+    out[2] = (e00 - e11 - e22 + e33)*w + 2*((e13 - e02)*u + (e23 + e01)*v)
+
+    # position dynamics
+    out[3] = r*v - q*w + forcing[0]
+    out[4] = p*w - r*u + forcing[1]
+    out[5] = q*u - p*v + forcing[2]
+
+    # rotational kinematics
+    out[6] = (-p * e1 - q * e2 - r * e3) * 0.5
+    out[7] = (p * e0 + r * e2 - q * e3) * 0.5
+    out[8] = (q * e0 - r * e1 + p * e3) * 0.5
+    out[9] = (r * e0 + q * e1 - p * e2) * 0.5
+
+    # rotatonal dynamics
+    out[10] = gamma1 * p * q - gamma2 * q * r + forcing[3]
+    out[11] = gamma5 * p * r - gamma6 * (p**2 - r**2) + forcing[4]
+    out[12] = gamma7 * p * q - gamma1 * q * r + forcing[5]
+
+@njit(cache=True, fastmath=True)
+def _rk4_step_nb(state, fm, forcing, stages, force_params, mav_params, dt):
+    # one RK4 step of state in place, with the forces and moments fm held over the step
+    mass, Jy, gamma3, gamma4, gamma8 = force_params
+    gamma1, gamma2, gamma5, gamma6, gamma7 = mav_params
+    _forcing_nb(fm, mass, Jy, gamma3, gamma4, gamma8, forcing)
+
+    k1 = stages[0]
+    k2 = stages[1]
+    k3 = stages[2]
+    k4 = stages[3]
+    tmp = stages[4]
+    _derivs_nb(state, forcing, gamma1, gamma2, gamma5, gamma6, gamma7, k1)
+    _rk4_stage(state, k1, dt/2., tmp)
+    _derivs_nb(tmp, forcing, gamma1, gamma2, gamma5, gamma6, gamma7, k2)
+    _rk4_stage(state, k2, dt/2., tmp)
+    _derivs_nb(tmp, forcing, gamma1, gamma2, gamma5, gamma6, gamma7, k3)
+    _rk4_stage(state, k3, dt, tmp)
+    _derivs_nb(tmp, forcing, gamma1, gamma2, gamma5, gamma6, gamma7, k4)
+
+    # combine the stages and normalize the quaternion
+    _rk4_combine(state, k1, k2, k3, k4, dt)
+
+@njit(cache=True, fastmath=True)
+def _rk4_stage(state, k, h, out):
+    # intermediate RK4 state: out = state + h*k
+    for i in range(13):
+        out[i] = state[i] + h * k[i]
+
+@njit(cache=True, fastmath=True)
+def _rk4_combine(state, k1, k2, k3, k4, dt):
+    # state += dt/6 * (k1 + 2*k2 + 2*k3 + k4), in place
+    for i in range(13):
+        state[i] += dt/6. * (k1[i] + 2.*k2[i] + 2.*k3[i] + k4[i])
+
+    # normalize the quaternion
+    normE = np.sqrt(state[6]**2 + state[7]**2 + state[8]**2 + state[9]**2)
+    for i in range(6, 10):
+        state[i] /= normE
@@ -1,4 +1,5 @@
 import numpy as np
+from math import sqrt
 import sys
 sys.path.append('..')
 from dubins_parameters import dubins_parameters
@@ -24,12 +25,23 @@ class path_manager:
         self.dubins_path = dubins_parameters()
         self.update_dubins = True
         self.dubins_state_changed = True
+        # preallocated buffers used by the straight line manager
+        self._p = np.zeros(3)
+        self._line_origin = np.zeros((3,1))
+        self._line_direction = np.zeros((3,1))
+        # unit tangents from each waypoint to the next (N,3), set when the waypoints change
+        self._tangents = None
+        self._q_prev = None
+        self._qi = None
+        # the straight line halfspace only changes with the pointers
+        self._halfspace_dirty = True
 
     def update(self, waypoints, radius, state):
         #check if waypoints change and reinitialize
         if waypoints.flag_waypoints_changed:
             self.num_waypoints = waypoints.num_waypoints
             self.flag_need_new_waypoints = False
+            self.update_tangents(waypoints)
             self.initialize_pointers()
             waypoints.flag_waypoints_changed = False
             self.manager_state = 1
@@ -48,26 +60,35 @@ class path_manager:
         return self.path
 
     def line_manager(self, waypoints, state):
-        qi = waypoints.ned[:, self.ptr_next] - waypoints.ned[:, self.ptr_current]
-        qi = qi / np.linalg.norm(qi) # issue here when not a next waypoint
-        q_prev = waypoints.ned[:, self.ptr_current] - waypoints.ned[:, self.ptr_previous]
-        q_prev = q_prev / np.linalg.norm(q_prev)
-
-        n = q_prev + qi
-        self.halfspace_n = (n / np.linalg.norm(n)).reshape((3,1))
-        self.halfspace_r = waypoints.ned[:, self.ptr_current].reshape((3,1))
-        p = np.array([[state.pn, state.pe, -state.h]]).T
+        ned = waypoints.ned
+        if self._halfspace_dirty:
+            # the pointers moved, look up the new line and halfspace
+            w_current = ned[:, self.ptr_current]
+            self._q_prev = self._tangents[self.ptr_previous]
+            self._qi = self._tangents[self.ptr_current] # issue here when not a next waypoint
+            n = self._q_prev + self._qi
+            n_norm = norm3(n)
+            self._hnx = n[0] / n_norm
+            self._hny = n[1] / n_norm
+            self._hnz = n[2] / n_norm
+            self._hrx = w_current[0]
+            self._hry = w_current[1]
+            self._hrz = w_current[2]
+            self._line_origin[:, 0] = ned[:, self.ptr_previous]
+            self._line_direction[:, 0] = self._q_prev
+            self._halfspace_dirty = False
+        p = self.position(state)
 
         self.path.flag = 'line'
         self.path.airspeed = waypoints.airspeed.item(self.ptr_current)
-        self.path.line_origin = waypoints.ned[:, self.ptr_previous].reshape((3,1))
-        self.path.line_direction = q_prev.reshape((3,1))
+        self.path.line_origin = self._line_origin
+        self.path.line_direction = self._line_direction
 
         crossed = self.inHalfSpace(p)
         if crossed:
             self.path.flag_path_changed = True
-            self.path.line_origin = waypoints.ned[:, self.ptr_current].reshape((3,1))
-            self.path.line_direction = qi.reshape((3,1))
+            self._line_origin[:, 0] = ned[:, self.ptr_current]
+            self._line_direction[:, 0] = self._qi
             self.increment_pointers()
         else:
             self.path.flag_path_changed = False
@@ -83,7 +104,7 @@ class path_manager:
         q_prev = (q_prev / np.linalg.norm(q_prev))
 
         var_theta = np.arccos(-q_prev.T @ qi)
-        p = np.array([[state.pn, state.pe, -state.h]]).T
+        p = self.position(state)
 
         if self.manager_state == 1:  #straight line part
             z = w_current - (radius/np.tan(var_theta/2.)) * q_prev
@@ -149,7 +170,7 @@ class path_manager:
                 self.path.flag_path_changed = False
 
     def dubins_manager(self, waypoints, radius, state):
-        p = np.array([[state.pn, state.pe, -state.h]]).T
+        p = self.position(state)
         self.path.airspeed = waypoints.airspeed.item(self.ptr_current)
 
         if self.update_dubins:
@@ -247,6 +268,13 @@ class path_manager:
         self.ptr_next = 2
         self.manager_state = 1
         self.update_dubins = True
+        self._halfspace_dirty = True
+
+    def update_tangents(self, waypoints):
+        # unit vectors from each waypoint to the next one, wrapping around like the pointers
+        ned = waypoints.ned[:, :self.num_waypoints]
+        d = np.roll(ned, -1, axis=1) - ned
+        self._tangents = (d / np.sqrt(np.sum(d * d, axis=0))).T.copy()
 
     def increment_pointers(self):
         # if  self.ptr_current < self.num_waypoints-1:
@@ -265,9 +293,43 @@ class path_manager:
         if self.ptr_next >= self.num_waypoints:
             self.ptr_next = 0
         self.update_dubins = True
+        self._halfspace_dirty = True
 
     def inHalfSpace(self, pos):
-        if (pos-self.halfspace_r).T @ self.halfspace_n >= 0:
-            return True
-        else:
-            return False
+        return (pos[0] - self._hrx) * self._hnx + (pos[1] - self._hry) * self._hny \
+            + (pos[2] - self._hrz) * self._hnz >= 0.0
+
+    def position(self, state):
+        # NED position of the MAV, written into a preallocated flat buffer
+        self._p[0] = state.pn
+        self._p[1] = state.pe
+        self._p[2] = -state.h
+        return self._p
+
+    # the halfspace is stored as scalars so inHalfSpace needs no temporaries
+    @property
+    def halfspace_n(self):
+        return np.array([[self._hnx, self._hny, self._hnz]]).T
+
+    @halfspace_n.setter
+    def halfspace_n(self, n):
+        # another manager took over the halfspace, the line one has to be rebuilt
+        self._halfspace_dirty = True
+        self._hnx = n.item(0)
+        self._hny = n.item(1)
+        self._hnz = n.item(2)
+
+    @property
+    def halfspace_r(self):
+        return np.array([[self._hrx, self._hry, self._hrz]]).T
+
+    @halfspace_r.setter
+    def halfspace_r(self, r):
+        self._halfspace_dirty = True
+        self._hrx = r.item(0)
+        self._hry = r.item(1)
+        self._hrz = r.item(2)
+
+def norm3(v):
+    # length of a flat 3-vector, without the overhead of np.linalg.norm
+    return sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2])
@@ -49,15 +49,8 @@ class mav_dynamics:
         self._state += time_step/6 * (k1 + 2*k2 + 2*k3 + k4)
 
         # normalize the quaternion
-        e0 = self._state.item(6)
-        e1 = self._state.item(7)
-        e2 = self._state.item(8)
-        e3 = self._state.item(9)
-        normE = np.sqrt(e0**2+e1**2+e2**2+e3**2)
-        self._state[6][0] = self._state.item(6)/normE
-        self._state[7][0] = self._state.item(7)/normE
-        self._state[8][0] = self._state.item(8)/normE
-        self._state[9][0] = self._state.item(9)/normE
+        e = self._state[6:10]
+        self._state[6:10] = e / np.sqrt(e.T @ e)
 
         # update the message class for the true state
         self._update_msg_true_state()
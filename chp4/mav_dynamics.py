@@ -55,15 +55,8 @@ class mav_dynamics:
         self._state += time_step/6 * (k1 + 2*k2 + 2*k3 + k4)
 
         # normalize the quaternion
-        e0 = self._state.item(6)
-        e1 = self._state.item(7)
-        e2 = self._state.item(8)
-        e3 = self._state.item(9)
-        normE = np.sqrt(e0**2+e1**2+e2**2+e3**2)
-        self._state[6][0] = self._state.item(6)/normE
-        self._state[7][0] = self._state.item(7)/normE
-        self._state[8][0] = self._state.item(8)/normE
-        self._state[9][0] = self._state.item(9)/normE
+        e = self._state[6:10]
+        self._state[6:10] = e / np.sqrt(e.T @ e)
 
         #update velocities
         self.updateVelocityData(wind)
@@ -100,10 +93,7 @@ class mav_dynamics:
         n = forces_moments.item(5)
 
         # position kinematics
-        # TODO Change the line below to use Quat2Rot
-        Rv_b = np.array([[e1**2 + e0**2 - e2**2 - e3**2, 2*(e1*e2 - e3*e0), 2*(e1*e3 + e2*e0)],
-                         [2*(e1*e2 + e3*e0), e2**2 + e0**2 - e1**2 - e3**2, 2*(e2*e3 - e1*e0)],
-                         [2*(e1*e3 - e2*e0), 2*(e2*e3 + e1*e0), e3**2 + e0**2 - e1**2 - e2**2]])
+        Rv_b = Quaternion2Rotation(state[6:10])
 
         pos_dot = Rv_b @ np.array([u, v, w]).T
         pn_dot = pos_dot.item(0)
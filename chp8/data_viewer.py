@@ -1,10 +1,20 @@
+import sys
+sys.path.append('..')
+import numpy as np
 from state_plotter.Plotter import Plotter
 from state_plotter.plotter_args import *
+from messages.state_msg import StateMsg, STATE_DTYPE
+
+# plotted fields of the true and estimated states, and the commanded ones
+TRUE_STATE_PLOTS = ('pn', 'pe', 'h', 'Va', 'alpha', 'beta', 'phi', 'theta', 'chi',
+                    'p', 'q', 'r', 'Vg', 'wn', 'we', 'psi', 'bx', 'by', 'bz')
+COMMAND_PLOTS = ('h', 'Va', 'phi', 'theta', 'chi')
 
 class data_viewer:
-    def __init__(self):
+    def __init__(self, history_length=10000):
         time_window_length=100
-        self.plotter = Plotter(plotting_frequency=100, # refresh plot every 100 time steps
+        self.plotting_frequency = 100 # refresh plot every 100 time steps
+        self.plotter = Plotter(plotting_frequency=1, # the refresh rate is handled by update
                                time_window=time_window_length)  # plot last time_window seconds of data
         # set up the plot window
         # define first row
@@ -83,42 +93,61 @@ class data_viewer:
                  ]
         # Add plots to the window
         self.plotter.add_plotboxes(plots)
-        # Define and label vectors for more convenient/natural data input
-        self.plotter.define_input_vector('true_state', ['pn', 'pe', 'h', 'Va', 'alpha', 'beta', 'phi', 'theta', 'chi',
-                                                        'p', 'q', 'r', 'Vg', 'wn', 'we', 'psi', 'bx', 'by', 'bz'])
-        self.plotter.define_input_vector('estimated_state', ['pn_e', 'pe_e', 'h_e', 'Va_e', 'alpha_e', 'beta_e',
-                                                             'phi_e', 'theta_e', 'chi_e', 'p_e', 'q_e', 'r_e',
-                                                             'Vg_e', 'wn_e', 'we_e', 'psi_e', 'bx_e', 'by_e', 'bz_e'])
-        self.plotter.define_input_vector('commands', ['h_c', 'Va_c', 'phi_c', 'theta_c', 'chi_c'])
+        # ring buffers with the last history_length states, the plots are set from them
+        # with one array per field instead of appending every sample to every plot
+        self._history_length = history_length
+        self._true_history = np.zeros(history_length, dtype=STATE_DTYPE)
+        self._estimated_history = np.zeros(history_length, dtype=STATE_DTYPE)
+        self._commanded_history = np.zeros(history_length, dtype=STATE_DTYPE)
+        self._time_history = np.zeros(history_length)
+        self._num_samples = 0
         # plot timer
         self.time = 0.
 
-    def update(self, true_state, estimated_state, commanded_state, ts):
-        commands = [commanded_state.h, # h_c
-                    commanded_state.Va, # Va_c
-                    commanded_state.phi, # phi_c
-                    commanded_state.theta, # theta_c
-                    commanded_state.chi] # chi_c
-        ## Add the state data in vectors
-        # the order has to match the order in lines 72-76
-        true_state_list = [true_state.pn, true_state.pe, true_state.h,
-                           true_state.Va, true_state.alpha, true_state.beta,
-                           true_state.phi, true_state.theta, true_state.chi,
-                           true_state.p, true_state.q, true_state.r,
-                           true_state.Vg, true_state.wn, true_state.we, true_state.psi,
-                           true_state.bx, true_state.by, true_state.bz]
-        estimated_state_list = [estimated_state.pn, estimated_state.pe, estimated_state.h,
-                                estimated_state.Va, estimated_state.alpha, estimated_state.beta,
-                                estimated_state.phi, estimated_state.theta, estimated_state.chi,
-                                estimated_state.p, estimated_state.q, estimated_state.r,
-                                estimated_state.Vg, estimated_state.wn, estimated_state.we, estimated_state.psi,
-                                estimated_state.bx, estimated_state.by, estimated_state.bz]
-        self.plotter.add_vector_measurement('true_state', true_state_list, self.time)
-        self.plotter.add_vector_measurement('estimated_state', estimated_state_list, self.time)
-        self.plotter.add_vector_measurement('commands', commands, self.time)
+    def update(self, true_state, estimated_state, commanded_state, ts, sim_time=None):
+        # the states are StateMsg objects or STATE_DTYPE records
+        # sim_time is the absolute time of the sample, when samples can be skipped
+        # between calls; otherwise the timer advances by ts after every call
+        if sim_time is not None:
+            self.time = sim_time
+        i = self._num_samples % self._history_length
+        self._true_history[i] = _as_record(true_state)
+        self._estimated_history[i] = _as_record(estimated_state)
+        self._commanded_history[i] = _as_record(commanded_state)
+        self._time_history[i] = self.time
+        self._num_samples += 1
+
+        if self._num_samples % self.plotting_frequency == 0:
+            self._set_plot_data()
 
         # Update and display the plot
         self.plotter.update_plots()
 
         # increment time
         self.time += ts
+
+    def _set_plot_data(self):
+        # oldest to newest window of the ring buffers, a view until they wrap around
+        if self._num_samples <= self._history_length:
+            window = slice(0, self._num_samples)
+            true_history = self._true_history[window]
+            estimated_history = self._estimated_history[window]
+            commanded_history = self._commanded_history[window]
+            times = self._time_history[window]
+        else:
+            i = self._num_samples % self._history_length
+            true_history = np.concatenate((self._true_history[i:], self._true_history[:i]))
+            estimated_history = np.concatenate((self._estimated_history[i:], self._estimated_history[:i]))
+            commanded_history = np.concatenate((self._commanded_history[i:], self._commanded_history[:i]))
+            times = np.concatenate((self._time_history[i:], self._time_history[:i]))
+
+        for name in TRUE_STATE_PLOTS:
+            self.plotter.set_data(name, true_history[name], times)
+            self.plotter.set_data(name + '_e', estimated_history[name], times)
+        for name in COMMAND_PLOTS:
+            self.plotter.set_data(name + '_c', commanded_history[name], times)
+
+def _as_record(state):
+    if isinstance(state, StateMsg):
+        return state.to_record()
+    return state
@@ -0,0 +1,415 @@
+"""
+mav_dynamics_batch
+    - this file implements the dynamic equations of motion for M MAVs at once
+    - same model as mav_dynamics, with the states stored as an (M,13) array
+      so every step is a handful of vectorized operations over the batch
+    - use unit quaternion for the attitude state
+
+"""
+import sys
+sys.path.append('..')
+import numpy as np
+
+# load message types
+from messages.state_msg import StateMsg, STATE_FIELDS, STATE_DTYPE
+from messages.msg_sensors import msg_sensors
+
+import parameters.aerosonde_parameters as MAV
+import parameters.sensor_parameters as SENSOR
+
+# number of MAVs integrated together. The stage buffers plus the temporaries of
+# _derivatives take roughly 1 kB per MAV, so a chunk stays resident in a 2 MB L2.
+# Much smaller chunks lose more to NumPy's per call overhead than they gain.
+CHUNK = 2048
+
+class mav_dynamics_batch:
+    def __init__(self, Ts, num_mavs):
+        self.ts_simulation = Ts
+        self.num_mavs = num_mavs
+        # _state[i] = [pn, pe, pd, u, v, w, e0, e1, e2, e3, p, q, r] for MAV i
+        state0 = np.array([MAV.pn0, MAV.pe0, MAV.pd0, MAV.u0, MAV.v0, MAV.w0,
+                           MAV.e0, MAV.e1, MAV.e2, MAV.e3, MAV.p0, MAV.q0, MAV.r0],
+                          dtype=np.float64)
+        self._state = np.tile(state0, (num_mavs, 1))
+        # preallocated buffers for the RK4 stages of one chunk
+        chunk = min(CHUNK, num_mavs)
+        self._k1 = np.empty((chunk, 13))
+        self._k2 = np.empty((chunk, 13))
+        self._k3 = np.empty((chunk, 13))
+        self._k4 = np.empty((chunk, 13))
+        self._tmp = np.empty((chunk, 13))
+
+        # rotations from body to inertial frame (M,3,3), refreshed in updateVelocityData
+        self._Rv_b = np.empty((num_mavs, 3, 3))
+        # exp(-M*(alpha - alpha0)) * exp(M*(alpha + alpha0)) does not depend on alpha,
+        # so the lift blending function needs only one exponential per call
+        self._exp_2Malpha0 = np.exp(2 * MAV.M * MAV.alpha0)
+
+        self._wind = np.zeros((num_mavs, 3))
+        self.updateVelocityData()
+        #store the forces
+        self._forces = np.zeros((num_mavs, 3))
+        self._Va = np.full(num_mavs, float(MAV.u0))
+        self._alpha = np.zeros(num_mavs)
+        self._beta = np.zeros(num_mavs)
+        #true states, every field is an array of length M
+        self.msg_true_state = StateMsg()
+
+        self.sensors = msg_sensors()
+        self._gps_eta_n = np.zeros(num_mavs)
+        self._gps_eta_e = np.zeros(num_mavs)
+        self._gps_eta_h = np.zeros(num_mavs)
+        self._t_gps = 999. #timer so that gps only updates every ts_gps seconds
+
+    ###################################
+    # public functions
+    def update_state(self, deltas, wind):
+        '''
+            Integrate the differential equations defining dynamics.
+            deltas is (M,4) [de, dt, da, dr] and wind is (M,6) [steady, gust].
+            Ts is the time step between function calls.
+        '''
+
+        forces_moments = self.calcForcesAndMoments(deltas)
+        # the forces and moments are held over the step, so scale them only once
+        forcing = self._forcing(forces_moments)
+
+        # Integrate ODE using Runge-Kutta RK4 algorithm, one cache sized chunk at a time
+        time_step = self.ts_simulation
+        for i0 in range(0, self.num_mavs, CHUNK):
+            i1 = min(i0 + CHUNK, self.num_mavs)
+            self._integrate_chunk(self._state[i0:i1], forcing[i0:i1], time_step)
+
+        #update velocities
+        self.updateVelocityData(wind)
+
+        # update the message class for the true state
+        self._update_msg_true_state()
+
+    def updateSensors(self):
+        theta = self.msg_true_state.theta
+        phi = self.msg_true_state.phi
+        g = MAV.gravity
+        m = MAV.mass
+        rho = MAV.rho
+        sigma_a = SENSOR.accel_sigma
+        sigma_g = SENSOR.gyro_sigma
+        M = self.num_mavs
+
+        self.sensors.gyro_x = self.msg_true_state.p + SENSOR.gyro_x_bias + np.random.randn(M) * sigma_g
+        self.sensors.gyro_y = self.msg_true_state.q + SENSOR.gyro_y_bias + np.random.randn(M) * sigma_g
+        self.sensors.gyro_z = self.msg_true_state.r + SENSOR.gyro_z_bias + np.random.randn(M) * sigma_g
+        self.sensors.accel_x = self._forces[:, 0]/m + g * np.sin(theta) + np.random.randn(M) * sigma_a
+        self.sensors.accel_y = self._forces[:, 1]/m - g * np.cos(theta) * np.sin(phi) + np.random.randn(M) * sigma_a
+        self.sensors.accel_z = self._forces[:, 2]/m - g * np.cos(theta) * np.cos(phi) + np.random.randn(M) * sigma_a
+        self.sensors.static_pressure = rho * g * self.msg_true_state.h + np.random.randn(M) * SENSOR.static_pres_sigma
+        self.sensors.diff_pressure = (rho * self.msg_true_state.Va**2)/2.0 + np.random.randn(M) * SENSOR.diff_pres_sigma
+
+        if self._t_gps >= SENSOR.ts_gps:
+            k_gps = SENSOR.gps_beta
+            Ts = SENSOR.ts_gps
+
+            self._gps_eta_n = np.exp(-k_gps * Ts) * self._gps_eta_n + np.random.randn(M) * SENSOR.gps_n_sigma
+            self._gps_eta_e = np.exp(-k_gps * Ts) * self._gps_eta_e + np.random.randn(M) * SENSOR.gps_e_sigma
+            self._gps_eta_h = np.exp(-k_gps * Ts) * self._gps_eta_h + np.random.randn(M) * SENSOR.gps_h_sigma
+            self.sensors.gps_n = self.msg_true_state.pn + self._gps_eta_n
+            self.sensors.gps_e = self.msg_true_state.pe + self._gps_eta_e
+            self.sensors.gps_h = self.msg_true_state.h + self._gps_eta_h
+            self.sensors.gps_Vg = self.msg_true_state.Vg + np.random.randn(M) * SENSOR.gps_Vg_sigma
+            self.sensors.gps_course = self.msg_true_state.chi + np.random.randn(M) * SENSOR.gps_course_sigma
+            self._t_gps = 0.0
+        else:
+            self._t_gps += self.ts_simulation
+
+    def true_state(self, i):
+        # scalar true state of MAV i, for the single aircraft autopilot and viewers
+        msg = StateMsg()
+        for name, value in vars(self.msg_true_state).items():
+            setattr(msg, name, value[i] if np.ndim(value) else value)
+        return msg
+
+    def true_state_records(self, out=None):
+        # true states of all MAVs as an (M,) STATE_DTYPE array, one row per MAV
+        if out is None:
+            out = np.zeros(self.num_mavs, dtype=STATE_DTYPE)
+        for name in STATE_FIELDS:
+            out[name] = getattr(self.msg_true_state, name)
+        return out
+
+    ###################################
+    # private functions
+    def _forcing(self, forces_moments):
+        # (M,6) forces/moments [fx, fy, fz, l, m, n] scaled into the terms they add to
+        # [u_dot, v_dot, w_dot, p_dot, q_dot, r_dot]
+        l = forces_moments[:, 3]
+        n = forces_moments[:, 5]
+        forcing = np.empty_like(forces_moments)
+        forcing[:, 0:3] = forces_moments[:, 0:3] / MAV.mass
+        forcing[:, 3] = MAV.gamma3 * l + MAV.gamma4 * n
+        forcing[:, 4] = forces_moments[:, 4] / MAV.Jy
+        forcing[:, 5] = MAV.gamma4 * l + MAV.gamma8 * n
+        return forcing
+
+    def _integrate_chunk(self, state, forcing, time_step):
+        # RK4 step of a view into _state, updated in place using the stage buffers
+        n = state.shape[0]
+        k1 = self._k1[:n]
+        k2 = self._k2[:n]
+        k3 = self._k3[:n]
+        k4 = self._k4[:n]
+        tmp = self._tmp[:n]
+
+        self._derivatives(state, forcing, k1)
+        np.multiply(k1, time_step/2., out=tmp)
+        tmp += state
+        self._derivatives(tmp, forcing, k2)
+        np.multiply(k2, time_step/2., out=tmp)
+        tmp += state
+        self._derivatives(tmp, forcing, k3)
+        np.multiply(k3, time_step, out=tmp)
+        tmp += state
+        self._derivatives(tmp, forcing, k4)
+
+        # state += time_step/6 * (k1 + 2*k2 + 2*k3 + k4)
+        k2 += k3
+        k2 *= 2.
+        k1 += k4
+        k1 += k2
+        k1 *= time_step/6.
+        state += k1
+
+        # normalize the quaternions
+        e = state[:, 6:10]
+        e /= np.sqrt(np.einsum('mi,mi->m', e, e))[:, None]
+
+    def _derivatives(self, state, forcing, x_dot=None):
+        """
+        for the dynamics xdot = f(x, u), returns f(x, u) for every MAV in the batch
+        forcing holds the force/moment terms from _forcing
+        """
+        # extract the states
+        u = state[:, 3]
+        v = state[:, 4]
+        w = state[:, 5]
+        e0 = state[:, 6]
+        e1 = state[:, 7]
+        e2 = state[:, 8]
+        e3 = state[:, 9]
+        p = state[:, 10]
+        q = state[:, 11]
+        r = state[:, 12]
+
+        if x_dot is None:
+            x_dot = np.empty_like(state)
+
+        # position kinematics (Rv_b @ [u, v, w]) expanded in the quaternion products
+        e00 = e0*e0
+        e11 = e1*e1
+        e22 = e2*e2
+        e33 = e3*e3
+        e01 = e0*e1
+        e02 = e0*e2
+        e03 = e0*e3
+        e12 = e1*e2
+        e13 = e1*e3
+        e23 = e2*e3
+        x_dot[:, 0] = (e00 + e11 - e22 - e33)*u + 2*((e12 - e03)*v + (e13 + e02)*w)
+        x_dot[:, 1] = (e00 - e11 + e22 - e33)*v + 2*((e12 + e03)*u + (e23 - e01)*w)
+        x_dot[:, 2] = (e00 - e11 - e22 + e33)*w + 2*((e13 - e02)*u + (e23 + e01)*v)
+
+        # position dynamics
+        x_dot[:, 3] = r*v - q*w + forcing[:, 0]
+        x_dot[:, 4] = p*w - r*u + forcing[:, 1]
+        x_dot[:, 5] = q*u - p*v + forcing[:, 2]
+
+        # rotational kinematics
+        x_dot[:, 6] = (-p * e1 - q * e2 - r * e3) * 0.5
+        x_dot[:, 7] = (p * e0 + r * e2 - q * e3) * 0.5
+        x_dot[:, 8] = (q * e0 - r * e1 + p * e3) * 0.5
+        x_dot[:, 9] = (r * e0 + q * e1 - p * e2) * 0.5
+
+        # rotatonal dynamics
+        x_dot[:, 10] = MAV.gamma1 * p * q - MAV.gamma2 * q * r + forcing[:, 3]
+        x_dot[:, 11] = MAV.gamma5 * p * r - MAV.gamma6 * (p**2 - r**2) + forcing[:, 4]
+        x_dot[:, 12] = MAV.gamma7 * p * q - MAV.gamma1 * q * r + forcing[:, 5]
+
+        return x_dot
+
+    def _update_msg_true_state(self):
+        # update the true state message:
+        e0 = self._state[:, 6]
+        ex = self._state[:, 7]
+        ey = self._state[:, 8]
+        ez = self._state[:, 9]
+        self.msg_true_state.pn = self._state[:, 0].copy()
+        self.msg_true_state.pe = self._state[:, 1].copy()
+        self.msg_true_state.h = -self._state[:, 2]
+        self.msg_true_state.phi = np.arctan2(2 * (e0*ex + ey*ez), e0**2 + ez**2 - ex**2 - ey**2)
+        self.msg_true_state.theta = np.arcsin(2 * (e0*ey - ex*ez))
+        self.msg_true_state.psi = np.arctan2(2*(e0*ez + ex*ey), e0**2 + ex**2 - ey**2 - ez**2)
+        self.msg_true_state.p = self._state[:, 10].copy()
+        self.msg_true_state.q = self._state[:, 11].copy()
+        self.msg_true_state.r = self._state[:, 12].copy()
+        self.msg_true_state.Va = self._Va
+        self.msg_true_state.alpha = self._alpha
+        self.msg_true_state.beta = self._beta
+        self.msg_true_state.Vg = np.linalg.norm(self._state[:, 3:6], axis=1)
+        self.calcGammaAndChi()
+        self.msg_true_state.wn = self._wind[:, 0].copy()
+        self.msg_true_state.we = self._wind[:, 1].copy()
+
+    def calcGammaAndChi(self):
+        Vg = np.einsum('mij,mj->mi', self._Rv_b, self._state[:, 3:6])
+        Vg_norm = np.linalg.norm(Vg, axis=1)
+
+        #negative because h_dot = Vg sin(gamma)
+        self.msg_true_state.gamma = np.arcsin(-Vg[:, 2] / Vg_norm)
+
+        # same as mav_dynamics: the cos(gamma) scaling of Vg_horz cancels in the ratio
+        chi = np.arccos(Vg[:, 0] / Vg_norm)
+        self.msg_true_state.chi = np.where(Vg[:, 1] < 0, -chi, chi)
+
+    def updateVelocityData(self, wind=None):
+        if wind is None:
+            wind = np.zeros((self.num_mavs, 6))
+        # the states have changed, so refresh the cached rotations
+        quaternion_to_rotation(self._state[:, 6:10], out=self._Rv_b)
+        #wind in body frame
+        self._wind = np.einsum('mji,mj->mi', self._Rv_b, wind[:, 0:3]) + wind[:, 3:]
+        V = self._state[:, 3:6]
+
+        #Compute Va
+        Vr = V - self._wind
+        self._Va = np.linalg.norm(Vr, axis=1)
+
+        #Compute alpha, arctan2 already gives +-pi/2 when Vr[:, 0] == 0
+        self._alpha = np.arctan2(Vr[:, 2], Vr[:, 0])
+
+        #Compute beta
+        self._beta = np.arcsin(Vr[:, 1] / self._Va)
+
+    def calcForcesAndMoments(self, delta):
+        # Calculate gravitational forces in the body frame, Rb_v @ [0, 0, mg]
+        fb_grav = MAV.mass * MAV.gravity * self._Rv_b[:, 2, :]
+
+        # Calculating longitudinal forces and moments
+        fx, fz, m = self.calcLongitudinalForcesAndMoments(delta[:, 0])
+        fx += fb_grav[:, 0]
+        fz += fb_grav[:, 2]
+
+        # Calculating lateral forces and moments
+        fy, l, n = self.calcLateralForcesAndMoments(delta[:, 2], delta[:, 3])
+        fy += fb_grav[:, 1]
+
+        # Propeller force and moments
+        fp, qp = self.calcThrustForceAndMoment(delta[:, 1], self._Va)
+        fx += fp
+        l += -qp
+
+        self._forces[:, 0] = fx
+        self._forces[:, 1] = fy
+        self._forces[:, 2] = fz
+        return np.stack((fx, fy, fz, l, m, n), axis=1)
+
+    def calcThrustForceAndMoment(self, dt, Va):
+        rho = MAV.rho
+        D = MAV.D_prop
+
+        V_in = MAV.V_max * dt
+
+        a = (rho * D**5) / ((2 * np.pi)**2) * MAV.C_Q0
+        b = (rho * (D**4) * MAV.C_Q1 * Va)/(2 * np.pi)  + (MAV.KQ**2)/MAV.R_motor
+        c = rho * (D**3) * MAV.C_Q2 * (Va**2) - (MAV.KQ * V_in)/MAV.R_motor + MAV.KQ * MAV.i0
+
+        Omega_op = (-b + np.sqrt((b**2) - 4 * a * c)) / (2. * a)
+        J_op = (2 * np.pi * Va) / (Omega_op * D)
+
+        CT = MAV.C_T2 * (J_op**2) + MAV.C_T1 * J_op + MAV.C_T0
+
+        Qp = MAV.KQ * (1./MAV.R_motor * (V_in - MAV.KQ * Omega_op) - MAV.i0)
+        Fp = CT * (rho * (Omega_op**2) * (D**4)) / ((2 * np.pi)**2)
+
+        return Fp, Qp
+
+    def calcLateralForcesAndMoments(self, da, dr):
+        b = MAV.b
+        Va = self._Va
+        beta = self._beta
+        p = self._state[:, 10]
+        r = self._state[:, 12]
+        rho = MAV.rho
+        S = MAV.S_wing
+
+        b2V = b / (2. * Va)
+        q_bar = 0.5 * rho * (Va**2) * S
+
+        # Calculating fy
+        fy = q_bar * (MAV.C_Y_0 + MAV.C_Y_beta * beta + MAV.C_Y_p * b2V * p +\
+             MAV.C_Y_r * b2V * r + MAV.C_Y_delta_a * da + MAV.C_Y_delta_r * dr)
+
+        # Calculating l
+        l = q_bar * b * (MAV.C_ell_0 + MAV.C_ell_beta * beta + MAV.C_ell_p * b2V * p +\
+            MAV.C_ell_r * b2V * r + MAV.C_ell_delta_a * da + MAV.C_ell_delta_r * dr)
+
+        # Calculating n
+        n = q_bar * b * (MAV.C_n_0 + MAV.C_n_beta * beta + MAV.C_n_p * b2V * p +\
+            MAV.C_n_r * b2V * r + MAV.C_n_delta_a * da + MAV.C_n_delta_r * dr)
+
+        return fy, l, n
+
+    def calcLongitudinalForcesAndMoments(self, de):
+        M = MAV.M
+        alpha = self._alpha
+        alpha0 = MAV.alpha0
+        rho = MAV.rho
+        Va = self._Va
+        S = MAV.S_wing
+        q = self._state[:, 11]
+        c = MAV.c
+
+        c2V = c / (2. * Va)
+        q_bar = 0.5 * rho * (Va**2) * S
+        e_posM = np.exp(M * (alpha + alpha0))
+        e_negM = self._exp_2Malpha0 / e_posM  # exp(-M * (alpha - alpha0))
+
+        sigma_alpha = (1 + e_negM + e_posM) / ((1 + e_negM)*(1 + e_posM))
+
+        # sign(alpha) * sin(alpha)**2 is sin(alpha) * |sin(alpha)|
+        sa = np.sin(alpha)
+        ca = np.cos(alpha)
+        CL_alpha = (1 - sigma_alpha) * (MAV.C_L_0 + MAV.C_L_alpha * alpha) + \
+                    sigma_alpha * (2 * sa * np.abs(sa) * ca)
+        F_lift = q_bar * (CL_alpha + MAV.C_L_q * c2V * q + MAV.C_L_delta_e * de)
+
+        CD_alpha = MAV.C_D_p + ((MAV.C_L_0 + MAV.C_L_alpha * alpha)**2) / (np.pi * MAV.e * MAV.AR)
+        F_drag = q_bar * (CD_alpha + MAV.C_D_q * c2V * q + MAV.C_D_delta_e * de)
+
+        # rotate lift and drag from the stability frame into the body frame
+        fx = -ca * F_drag + sa * F_lift
+        fz = -sa * F_drag - ca * F_lift
+
+        m = q_bar * c * (MAV.C_m_0 + MAV.C_m_alpha * alpha + MAV.C_m_q * c2V * q + MAV.C_m_delta_e * de)
+
+        return fx, fz, m
+
+def quaternion_to_rotation(e, out=None):
+    # batched Quaternion2Rotation: (M,4) quaternions to (M,3,3) rotations Rv_b
+    e0 = e[:, 0]
+    ex = e[:, 1]
+    ey = e[:, 2]
+    ez = e[:, 3]
+
+    if out is None:
+        out = np.empty((e.shape[0], 3, 3))
+    R = out
+    R[:, 0, 0] = e0**2 + ex**2 - ey**2 - ez**2
+    R[:, 0, 1] = 2*(ex*ey - e0*ez)
+    R[:, 0, 2] = 2*(ex*ez + e0*ey)
+    R[:, 1, 0] = 2*(ex*ey + e0*ez)
+    R[:, 1, 1] = e0**2 - ex**2 + ey**2 - ez**2
+    R[:, 1, 2] = 2*(ey*ez - e0*ex)
+    R[:, 2, 0] = 2*(ex*ez - e0*ey)
+    R[:, 2, 1] = 2*(ey*ez + e0*ex)
+    R[:, 2, 2] = e0**2 - ex**2 - ey**2 + ez**2
+
+    return R
@@ -0,0 +1,127 @@
+"""
+mav_dynamics_cuda
+    - batched dynamics for large MAV swarms with the RK4 step on a CUDA GPU
+    - one GPU thread integrates one MAV, keeping the whole RK4 step in
+      registers/local memory; the states stay resident on the device
+    - forces and moments, velocity data and messages are still computed on
+      the CPU by mav_dynamics_batch, so each step copies the (M,6) scaled
+      forcing terms to the GPU and the (M,13) states back through pinned buffers
+
+"""
+import sys
+sys.path.append('..')
+import numpy as np
+from numba import cuda, float64
+
+import parameters.aerosonde_parameters as MAV
+from mav_dynamics import _derivs_nb
+from mav_dynamics_batch import mav_dynamics_batch
+
+# the derivatives of mav_dynamics, compiled again as a device function
+_derivs_device = cuda.jit(device=True)(_derivs_nb.py_func)
+
+# constant parameters, frozen into the kernel when it is compiled
+_gamma1 = MAV.gamma1
+_gamma2 = MAV.gamma2
+_gamma5 = MAV.gamma5
+_gamma6 = MAV.gamma6
+_gamma7 = MAV.gamma7
+
+class mav_dynamics_cuda(mav_dynamics_batch):
+    def __init__(self, Ts, num_mavs, threads_per_block=128):
+        if not cuda.is_available():
+            raise RuntimeError('mav_dynamics_cuda needs a CUDA capable GPU, use mav_dynamics_batch instead')
+        mav_dynamics_batch.__init__(self, Ts, num_mavs)
+        self._threads_per_block = threads_per_block
+        self._blocks = (num_mavs + threads_per_block - 1) // threads_per_block
+        self._stream = cuda.stream()
+        # host side buffers are pinned so the copies can be asynchronous
+        state = self._state
+        self._state = cuda.pinned_array((num_mavs, 13), dtype=np.float64)
+        self._state[:] = state
+        self._fm = cuda.pinned_array((num_mavs, 6), dtype=np.float64)
+        # device copies, the device state is the one that gets integrated
+        self._d_state = cuda.to_device(self._state, stream=self._stream)
+        self._d_fm = cuda.device_array((num_mavs, 6), dtype=np.float64, stream=self._stream)
+        self._stream.synchronize()
+
+    ###################################
+    # public functions
+    def update_state(self, deltas, wind):
+        '''
+            Integrate the differential equations defining dynamics.
+            deltas is (M,4) [de, dt, da, dr] and wind is (M,6) [steady, gust].
+            Ts is the time step between function calls.
+        '''
+
+        forces_moments = self.calcForcesAndMoments(deltas)
+        # the forces and moments are held over the step, so scale them only once
+        self._fm[:] = self._forcing(forces_moments)
+
+        # Integrate ODE using Runge-Kutta RK4 algorithm on the GPU
+        self._d_fm.copy_to_device(self._fm, stream=self._stream)
+        _rk4_kernel[self._blocks, self._threads_per_block, self._stream](
+            self._d_state, self._d_fm, self.ts_simulation)
+        self._d_state.copy_to_host(self._state, stream=self._stream)
+        self._stream.synchronize()
+
+        #update velocities
+        self.updateVelocityData(wind)
+
+        # update the message class for the true state
+        self._update_msg_true_state()
+
+    def set_state(self, state):
+        # overwrite the (M,13) states, on the host and on the device
+        self._state[:] = state
+        self._d_state.copy_to_device(self._state, stream=self._stream)
+        self._stream.synchronize()
+        self.updateVelocityData()
+        self._update_msg_true_state()
+
+###################################
+# compiled kernels
+@cuda.jit
+def _rk4_kernel(state, forcing, dt):
+    # one thread per MAV: state[i] += dt/6 * (k1 + 2*k2 + 2*k3 + k4), then normalize
+    i = cuda.grid(1)
+    if i >= state.shape[0]:
+        return
+
+    x = cuda.local.array(13, float64)
+    tmp = cuda.local.array(13, float64)
+    k = cuda.local.array(13, float64)
+    acc = cuda.local.array(13, float64)
+    f = cuda.local.array(6, float64)
+    for j in range(13):
+        x[j] = state[i, j]
+    for j in range(6):
+        f[j] = forcing[i, j]
+
+    # k1
+    _derivs_device(x, f, _gamma1, _gamma2, _gamma5, _gamma6, _gamma7, k)
+    for j in range(13):
+        acc[j] = k[j]
+        tmp[j] = x[j] + dt/2. * k[j]
+    # k2
+    _derivs_device(tmp, f, _gamma1, _gamma2, _gamma5, _gamma6, _gamma7, k)
+    for j in range(13):
+        acc[j] += 2. * k[j]
+        tmp[j] = x[j] + dt/2. * k[j]
+    # k3
+    _derivs_device(tmp, f, _gamma1, _gamma2, _gamma5, _gamma6, _gamma7, k)
+    for j in range(13):
+        acc[j] += 2. * k[j]
+        tmp[j] = x[j] + dt * k[j]
+    # k4
+    _derivs_device(tmp, f, _gamma1, _gamma2, _gamma5, _gamma6, _gamma7, k)
+    for j in range(13):
+        x[j] += dt/6. * (acc[j] + k[j])
+
+    # normalize the quaternion
+    normE = (x[6]**2 + x[7]**2 + x[8]**2 + x[9]**2)**0.5
+    for j in range(6, 10):
+        x[j] /= normE
+
+    for j in range(13):
+        state[i, j] = x[j]
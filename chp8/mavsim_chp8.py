@@ -13,14 +13,15 @@ import parameters.sim_params as SIM
 from mav_viewer import MAV_Viewer
 from mav_dynamics import mav_dynamics as Dynamics
 from messages.msg_autopilot import msg_autopilot
-from messages.state_msg import StateMsg
+from messages.state_msg import StateMsg, STATE_DTYPE
 from data_viewer import data_viewer
 from wind_simulation import wind_simulation
 from autopilot import autopilot
 from observer import observer
 from tools.signals import signals
 
-import copy
+import queue
+import threading
 
 # initialize dynamics object
 dyn = Dynamics(SIM.ts_sim)
@@ -38,35 +39,71 @@ mav_view = MAV_Viewer()
 data_view = data_viewer()
 
 # initialize the simulation time
-sim_time = SIM.t0
+sim_times = np.arange(SIM.t0, SIM.t_end, SIM.ts_sim)
+
+# precompute the commanded values for the whole run
+Va_commands = Va_command.square_vec(sim_times)
+chi_commands = chi_command.square_vec(sim_times)
+h_commands = h_command.square_vec(sim_times)
 
 temp = StateMsg();
 
+# the viewers redraw on the main thread, the physics runs on a worker thread and
+# hands them snapshots through a one slot queue, dropping frames the viewers can't keep up with
+frames = queue.Queue(maxsize=1)
+# the snapshots are written into a small ring of [true, estimated, commanded] records
+# and the queue carries their slot, at most two slots are in use (queued and being drawn)
+frame_log = np.zeros((4, 3), dtype=STATE_DTYPE).view(np.recarray)
+frame_times = np.zeros(4)
+
+def simulate():
+    num_frames = 0
+    for k in range(len(sim_times)):
+        #-------get commanded values-------------
+        commands.airspeed_command = Va_commands[k]
+        commands.course_command = chi_commands[k]
+        commands.altitude_command = h_commands[k]
+
+        #-----------controller---------------------
+        measurements = dyn.sensors
+        estimated_state = obsv.update(measurements)
+        delta, commanded_state = ctrl.update(commands, estimated_state)
+
+        #------------Physical System----------------------
+        current_wind = wind.update(dyn._Va)
+        dyn.update_state(delta, current_wind)
+        dyn.updateSensors()
+
+        #-------hand the state to the viewers---------------
+        if not frames.full():
+            slot = num_frames % len(frame_log)
+            num_frames += 1
+            frame = frame_log[slot]
+            frame[0] = dyn.msg_true_state.to_record()
+            frame[1] = estimated_state.to_record()
+            frame[2] = commanded_state.to_record()
+            frame_times[slot] = sim_times[k]
+            frames.put_nowait(slot)
+
+sim_thread = threading.Thread(target=simulate, daemon=True)
+
 # main simulation loop
 print("Press Ctrl-Q to exit...")
-while sim_time < SIM.t_end:
-    #-------get commanded values-------------
-    commands.airspeed_command = Va_command.square(sim_time)
-    commands.course_command = chi_command.square(sim_time)
-    commands.altitude_command = h_command.square(sim_time)
-
-    #-----------controller---------------------
-    measurements = dyn.sensors
-    estimated_state = obsv.update(measurements)
-    delta, commanded_state = ctrl.update(commands, estimated_state)
-
-    #------------Physical System----------------------
-    current_wind = wind.update(dyn._Va)
-    dyn.update_state(delta, current_wind)
-    dyn.updateSensors()
+sim_thread.start()
+while sim_thread.is_alive() or not frames.empty():
+    try:
+        slot = frames.get(timeout=0.05)
+    except queue.Empty:
+        mav_view.application.processEvents()
+        continue
+    true_state, estimated_state, commanded_state = frame_log[slot]
 
     #-------update viewer---------------
-    mav_view.update(dyn.msg_true_state)
-    data_view.update(dyn.msg_true_state,
+    mav_view.update(true_state)
+    # frames can be dropped, so the plots get the absolute time of each one
+    data_view.update(true_state,
                     estimated_state,
                     commanded_state,
-                    SIM.ts_sim)
-
-    #-------increment time-------------
-    sim_time += SIM.ts_sim
+                    SIM.ts_sim,
+                    sim_time=frame_times[slot])
 input("Press Enter to Close")
@@ -1,4 +1,12 @@
 #message for the state. Will be used to pass state between different classes
+import numpy as np
+from operator import attrgetter
+
+# the fields of StateMsg, and the matching structured dtype for storing states in arrays
+STATE_FIELDS = ('pn', 'pe', 'h', 'phi', 'theta', 'psi', 'Va', 'alpha', 'beta',
+                'p', 'q', 'r', 'Vg', 'gamma', 'chi', 'wn', 'we', 'bx', 'by', 'bz')
+STATE_DTYPE = np.dtype([(name, np.float64) for name in STATE_FIELDS])
+_get_state_fields = attrgetter(*STATE_FIELDS)
 
 class StateMsg:
     def __init__(self):
@@ -22,3 +30,8 @@ class StateMsg:
         self.bx = 0.0       #gyro bias along roll axis in rad/s
         self.by = 0.0       #gyro bias along pitch axis in rad/s
         self.bz = 0.0       #gyro bias along yaw axis in rad/s
+
+    def to_record(self):
+        # all fields as one tuple in STATE_FIELDS order, can be assigned
+        # directly to an element of a STATE_DTYPE array
+        return _get_state_fields(self)
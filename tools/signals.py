@@ -50,6 +50,14 @@ class signals:
             self.last_switch = time
         return y + self.dc_offset
 
+    def square_vec(self, time):
+        '''square wave function evaluated at every time in the array time'''
+        time = np.asarray(time)
+        phase = np.mod(time - self.start_time, self.period)
+        y = np.where(phase < self.period / 2.0, self.amplitude, -self.amplitude)
+        y = np.where(time < self.start_time, 0.0, y)
+        return y + self.dc_offset
+
     def sawtooth(self, time):
         '''sawtooth wave function'''
         if time < self.start_time:
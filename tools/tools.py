@@ -29,18 +29,27 @@ def Euler2Quaternion(phi, theta, psi):
 
     return quat
 
-def Quaternion2Rotation(e):
+def Quaternion2Rotation(e, out=None):
     # This currently returns Ri_b
+    # pass a preallocated (3,3) array as out to fill it in place
     e0 = e.item(0)
     ex = e.item(1)
     ey = e.item(2)
     ez = e.item(3)
 
-    R = np.array([[e0**2 + ex**2 - ey**2 - ez**2, 2*(ex*ey - e0*ez), 2*(ex*ez + e0*ey)],
-                  [2*(ex*ey + e0*ez), e0**2 - ex**2 + ey**2 - ez**2, 2*(ey*ez - e0*ex)],
-                  [2*(ex*ez - e0*ey), 2*(ey*ez + e0*ex), e0**2 - ex**2 - ey**2 + ez**2]])
+    if out is None:
+        out = np.empty((3, 3))
+    out[0, 0] = e0**2 + ex**2 - ey**2 - ez**2
+    out[0, 1] = 2*(ex*ey - e0*ez)
+    out[0, 2] = 2*(ex*ez + e0*ey)
+    out[1, 0] = 2*(ex*ey + e0*ez)
+    out[1, 1] = e0**2 - ex**2 + ey**2 - ez**2
+    out[1, 2] = 2*(ey*ez - e0*ex)
+    out[2, 0] = 2*(ex*ez - e0*ey)
+    out[2, 1] = 2*(ey*ez + e0*ex)
+    out[2, 2] = e0**2 - ex**2 - ey**2 + ez**2
 
-    return R
+    return out
 
 def Euler2Rotation(phi, theta, psi):
     q = Euler2Quaternion(phi, theta, psi)